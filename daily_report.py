@@ -1,21 +1,42 @@
 import time
 import re
+import hashlib
+import csv
+import json
+import zipfile
+import tempfile
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 import pandas as pd
-import openpyxl
 from pymongo import MongoClient
+from bson import ObjectId
 from datetime import datetime
 import smtplib
 from email.message import EmailMessage
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
-from collections import defaultdict
-from openpyxl.styles import Alignment
+import logging
+import threading
+from functools import lru_cache
+from itertools import takewhile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson                          # Faster JSON for HF request/response bodies
+except ImportError:
+    orjson = None
 
 # ================== CONFIG ==================
 
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = "showtime_reports"
 COLLECTION_NAME = "work_reports"
+MONGO_POOL_SIZE = 10
+MONGO_BATCH_SIZE = 500
+REPORT_FIELDS = ("team", "tasks", "department", "employee_name")
 
 SMTP_SERVER = "smtp.gmail.com"
 SMTP_PORT = 587
@@ -27,30 +48,90 @@ RECIPIENTS = ["rs@showtimeconsulting.in",
 
 TEMPLATE_FILE = "Tasks template.xlsx"      # Commit this file to repo root
 OUTPUT_FILE = "Daily_Work_Report.xlsx"
+TEMPLATE_SHEET = "xl/worksheets/sheet1.xml"
+TEMPLATE_SHARED_STRINGS = "xl/sharedStrings.xml"
+TEMPLATE_STYLES = "xl/styles.xml"
+TEMPLATE_FIRST_TEAM_ROW = 6
+TEAM_COL = "B"
+SUMMARY_COL = "G"
+XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
 
 HF_MODEL = "facebook/bart-large-cnn"
 HF_API_URL = f"https://api-inference.huggingface.co/models/{HF_MODEL}"
 HF_API_KEY = os.getenv("HF_API_KEY")
 HF_HEADERS = {"Authorization": f"Bearer {HF_API_KEY}"}
+HF_PARAMETERS = {"max_length": 150, "min_length": 30, "do_sample": False}
+HF_CHUNK_CHARS = 3500                      # ~1000 BART tokens per chunk
+SMALL_TEAM_MAX_TASKS = 3                   # Teams at/below this skip HF summarization
+SMALL_TEAM_MAX_CHARS = 200
+HF_MAX_WORKERS = 8                         # Teams summarized concurrently
+HF_MAX_CONCURRENT_REQUESTS = 4             # Cap in-flight HF calls, including ones backing off
+HF_RETRIES = 2                             # Retries on 502/503/504 after the first attempt
+
+_HF_SEMAPHORE = threading.Semaphore(HF_MAX_CONCURRENT_REQUESTS)
+
+SUMMARY_CACHE_DIR = Path(os.getenv("SUMMARY_CACHE_DIR", ".cache/summaries"))
+SUMMARY_CACHE_TTL = int(os.getenv("HF_CACHE_TTL", 30 * 24 * 3600))   # Seconds; 0 disables expiry
 
 # ============================================
 
-def hf_post(text, timeout=120, max_retries=3):
-    payload = {"inputs": text, "parameters": {"max_length": 150, "min_length": 30, "do_sample": False}}
-    backoff = 2
-    for attempt in range(1, max_retries + 1):
-        try:
-            resp = requests.post(HF_API_URL, headers=HF_HEADERS, json=payload, timeout=timeout)
-            resp.raise_for_status()
-            return resp.json()
-        except requests.exceptions.RequestException as e:
-            print(f"[WARN] HF request attempt {attempt}/{max_retries} failed: {e}")
-            if attempt == max_retries:
-                raise
-            sleep_for = backoff ** attempt
-            print(f"[INFO] Retrying after {sleep_for}s...")
-            time.sleep(sleep_for)
-    raise RuntimeError("HF post retries exhausted")
+LOG = logging.getLogger(__name__)
+
+_SENT_SPLIT = re.compile(r'(?<=[\.\!\?])\s+')
+_FALLBACK_SPLIT = re.compile(r'[\n;]+')
+_ENDING_PUNCT = ".!?"
+_ILLEGAL_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+class HFRetry(Retry):
+    # urllib3 2.x skips the sleep before the first retry; keep the original backoff_factor * 2**(n-1)
+    # schedule (2s, then 4s) so a loading model (503) gets time to come up.
+    def get_backoff_time(self):
+        errors = len(list(takewhile(lambda x: x.redirect_location is None, reversed(self.history))))
+        if errors == 0:
+            return 0
+        return float(min(self.backoff_max, self.backoff_factor * (2 ** (errors - 1))))
+
+def build_hf_session(max_retries, poolmanager=None):
+    # Keep-alive connection pool shared by all HF calls; the adapter handles retries/backoff
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=max_retries)
+    if poolmanager is not None:
+        adapter.poolmanager = poolmanager
+    session = requests.Session()
+    session.headers.update(HF_HEADERS)
+    session.headers["Content-Type"] = "application/json"
+    session.mount("https://", adapter)
+    return session
+
+_SESSION = build_hf_session(HFRetry(
+    total=HF_RETRIES,
+    backoff_factor=2,
+    status_forcelist=[502, 503, 504],
+    allowed_methods=frozenset(["POST"]),
+    raise_on_status=False,
+))
+# Single-attempt twin for the warm-up: no adapter retries, same urllib3 pool manager
+_WARMUP_SESSION = build_hf_session(0, _SESSION.get_adapter("https://").poolmanager)
+
+# `text` may be a single string or a list of strings (batched into one request)
+def hf_post(text, timeout=120):
+    payload = {"inputs": text, "parameters": HF_PARAMETERS}
+    try:
+        body = orjson.dumps(payload) if orjson else json.dumps(payload).encode("utf-8")
+        # Adapter retries and their backoff sleeps run inside post(), so a request that is
+        # backing off keeps its rate-limit slot until it finally succeeds or gives up.
+        with _HF_SEMAPHORE:
+            resp = _SESSION.post(HF_API_URL, data=body, timeout=timeout)
+        resp.raise_for_status()
+        return orjson.loads(resp.content) if orjson else resp.json()
+    except requests.exceptions.HTTPError as e:
+        # 4xx are not retried; the urllib3 Retry history says how many attempts were made
+        retries = getattr(e.response.raw, "retries", None)
+        attempts = len(retries.history) + 1 if retries is not None else 1
+        LOG.warning("HF request failed with HTTP %s after %s attempt(s): %s", e.response.status_code, attempts, e)
+        raise
+    except requests.exceptions.RequestException as e:
+        LOG.warning("HF request failed: %s", e)
+        raise
 
 def extract_summary_from_response(resp):
     if resp is None:
@@ -71,17 +152,28 @@ def extract_summary_from_response(resp):
                 return resp[key]
     return None
 
+# One summary per input for batched (list payload) HF responses
+def extract_summaries_from_response(resp):
+    if not isinstance(resp, list):
+        return [extract_summary_from_response(resp)]
+    summaries = []
+    for item in resp:
+        # Batched responses may nest each input's result in its own list
+        summaries.append(extract_summary_from_response(item if isinstance(item, list) else [item]))
+    return summaries
+
 def split_to_bullets(text, max_points=5):
     if not text:
         return []
-    sentences = re.split(r'(?<=[\.\!\?])\s+', text.strip())
-    clean = [s.strip().rstrip('.!?') for s in sentences if len(s.strip()) > 10]
+    sentences = _SENT_SPLIT.split(text.strip())
+    clean = [s.strip().rstrip(_ENDING_PUNCT) for s in sentences if len(s.strip()) > 10]
     if len(clean) == 0:
-        parts = re.split(r'[\n;]+', text)
+        parts = _FALLBACK_SPLIT.split(text)
         clean = [p.strip() for p in parts if len(p.strip()) > 10]
     return clean[:max_points]
 
-def bulletify_tasks(tasks_list, max_bullets=5):
+def _normalize_tasks(tasks_list):
+    # Stripped, non-empty, order-preserving unique task strings
     dedup = []
     seen = set()
     for t in tasks_list:
@@ -89,118 +181,318 @@ def bulletify_tasks(tasks_list, max_bullets=5):
         if s and s not in seen:
             dedup.append(s)
             seen.add(s)
-        if len(dedup) >= max_bullets:
-            break
     return dedup
 
-def summarize_team_tasks(tasks_list, max_points=5):
-    dedup = []
-    seen = set()
-    for t in tasks_list:
-        s = str(t).strip()
-        if s and s not in seen:
-            dedup.append(s)
-            seen.add(s)
-    if not dedup:
-        return "- No tasks reported."
+def summary_cache_key(dedup, max_points):
+    # Model and generation settings are part of the key so changing them invalidates old entries
+    settings = json.dumps({"model": HF_MODEL, "parameters": HF_PARAMETERS, "max_points": max_points}, sort_keys=True)
+    payload = settings + "\n" + "\n".join(sorted(dedup))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
-    joined_len = sum(len(x) for x in dedup)
+def is_cache_entry_expired(path):
+    return bool(SUMMARY_CACHE_TTL) and time.time() - path.stat().st_mtime > SUMMARY_CACHE_TTL
+
+def read_cached_summary(key):
+    path = SUMMARY_CACHE_DIR / f"{key}.txt"
     try:
-        if len(dedup) <= 6 and joined_len < 1200:
-            text = " . ".join(dedup)
-            resp = hf_post(text, timeout=120, max_retries=3)
-            summary_text = extract_summary_from_response(resp)
-            if summary_text:
-                points = split_to_bullets(summary_text, max_points)
-                if points:
-                    return "\n".join([f"- {p}" for p in points])
-    except Exception as e:
-        print(f"[WARN] HF single-call summarize failed: {e}")
+        if is_cache_entry_expired(path):
+            path.unlink()
+            return None
+        return path.read_text(encoding="utf-8")
+    except OSError:
+        return None
 
-    chunk_size = 10
-    chunk_summaries = []
-    for i in range(0, len(dedup), chunk_size):
-        chunk = dedup[i:i+chunk_size]
-        chunk_text = " . ".join(chunk)
+def prune_summary_cache():
+    # Expired entries for task sets that never recur would otherwise be kept forever
+    removed = 0
+    for path in SUMMARY_CACHE_DIR.glob("*.txt"):
         try:
-            resp = hf_post(chunk_text, timeout=120, max_retries=2)
-            chunk_summary = extract_summary_from_response(resp)
-            chunk_summaries.append(chunk_summary or chunk_text[:1000])
-        except Exception as e:
-            print(f"[WARN] HF chunk summarization failed (chunk {i//chunk_size}): {e}")
-            chunk_summaries.append(" . ".join(chunk))
+            if is_cache_entry_expired(path):
+                path.unlink()
+                removed += 1
+        except OSError:
+            pass
+    # Temp files left behind by an interrupted write (nothing else is writing yet)
+    for path in SUMMARY_CACHE_DIR.glob("*.tmp"):
+        path.unlink(missing_ok=True)
+    if removed:
+        LOG.info("Pruned %s expired summary cache entries", removed)
 
+def write_cached_summary(key, summary_text):
+    # Write to a temp file and rename, so concurrent readers (and a killed job) never
+    # see a partially written entry
+    tmp_path = None
     try:
-        combined = " ".join(chunk_summaries)
-        resp2 = hf_post(combined, timeout=120, max_retries=2)
-        final_summary_text = extract_summary_from_response(resp2)
-        if final_summary_text:
-            points = split_to_bullets(final_summary_text, max_points)
-            if points:
-                return "\n".join([f"- {p}" for p in points])
+        SUMMARY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=SUMMARY_CACHE_DIR, suffix=".tmp", delete=False
+        ) as f:
+            tmp_path = f.name
+            f.write(summary_text)
+        os.replace(tmp_path, SUMMARY_CACHE_DIR / f"{key}.txt")
+    except OSError as e:
+        LOG.warning("Could not write summary cache: %s", e)
+        if tmp_path:
+            Path(tmp_path).unlink(missing_ok=True)
+
+def pack_chunks(tasks, max_chars=HF_CHUNK_CHARS, sep=" . "):
+    # Greedy packing by character length so each chunk stays under the model's input limit
+    chunks = []
+    cur, cur_len = [], 0
+    for t in tasks:
+        t = t[:max_chars]
+        if cur and cur_len + len(sep) + len(t) > max_chars:
+            chunks.append(sep.join(cur))
+            cur, cur_len = [], 0
+        cur_len += len(t) + (len(sep) if cur else 0)
+        cur.append(t)
+    if cur:
+        chunks.append(sep.join(cur))
+    return chunks
+
+# Both summarize paths return (bullets or None, complete); `complete` is False when any
+# part fell back to raw task text, so the result must not be cached.
+def summarize_single_call(dedup, max_points):
+    try:
+        resp = hf_post(" . ".join(dedup), timeout=120)
     except Exception as e:
-        print(f"[WARN] HF final summarization failed: {e}")
+        LOG.warning("HF single-call summarize failed: %s", e)
+        return None, False
+    points = split_to_bullets(extract_summary_from_response(resp), max_points)
+    if points:
+        return "\n".join([f"- {p}" for p in points]), True
+    return None, False
+
+def summarize_chunked(dedup, max_points):
+    # Send all chunks as one list payload: a single HF round trip instead of one per chunk
+    chunks = pack_chunks(dedup)
+    try:
+        resp = hf_post(chunks, timeout=120)
+    except Exception as e:
+        LOG.warning("HF batched chunk summarization failed: %s", e)
+        return None, False
+    summaries = extract_summaries_from_response(resp)[:len(chunks)]
+    if not any(summaries):
+        return None, False
+    summaries += [None] * (len(chunks) - len(summaries))
+    complete = all(summaries)
+    combined = " ".join(summary or chunk[:1000] for summary, chunk in zip(summaries, chunks))
+
+    # Reduce only when several chunk summaries are still too long together
+    if len(chunks) > 1 and len(combined) > 1200:
+        final_summary_text = None
+        try:
+            final_summary_text = extract_summary_from_response(hf_post(combined, timeout=120))
+        except Exception as e:
+            LOG.warning("HF final summarization failed: %s", e)
+        if final_summary_text:
+            combined = final_summary_text
+        else:
+            complete = False
+
+    points = split_to_bullets(combined, max_points)
+    if points:
+        return "\n".join([f"- {p}" for p in points]), complete
+    return None, False
+
+# `dedup` is the output of _normalize_tasks
+def summarize_team_tasks(dedup, max_points=5):
+    if not dedup:
+        return "- No tasks reported."
+
+    joined_len = sum(len(x) for x in dedup)
+    # Trivially small teams: the original bullets read better than a model summary
+    if len(dedup) <= SMALL_TEAM_MAX_TASKS or joined_len < SMALL_TEAM_MAX_CHARS:
+        return "\n".join([f"- {p}" for p in dedup[:max_points]])
+
+    cache_key = summary_cache_key(dedup, max_points)
+    cached = read_cached_summary(cache_key)
+    if cached:
+        return cached
+
+    # Exactly one HF round trip for small inputs; one batched call (+ reduce if needed) otherwise
+    if len(dedup) <= 6 and joined_len < 1200:
+        result, complete = summarize_single_call(dedup, max_points)
+    else:
+        result, complete = summarize_chunked(dedup, max_points)
+    if result:
+        if complete:
+            write_cached_summary(cache_key, result)
+        return result
 
-    fallback = bulletify_tasks(dedup, max_bullets=max_points)
+    fallback = dedup[:max_points]
     return "\n".join([f"- {p}" for p in fallback])
 
-def generate_excel_by_team(data):
-    team_tasks = defaultdict(list)
-    for record in data:
-        team = record.get("team", "").strip()
-        tasks = record.get("tasks", []) or []
-        for t in tasks:
-            if isinstance(t, dict):
-                details = t.get("details", "").strip()
-            else:
-                details = str(t).strip()
-            if details:
-                team_tasks[team].append(details)
-
-    wb = openpyxl.load_workbook(TEMPLATE_FILE)
-    ws = wb.active
-
-    title_cell = ws["B4"]
-    if title_cell.value and "DD|MM|YYYY" in str(title_cell.value):
-        title_cell.value = str(title_cell.value).replace("DD|MM|YYYY", datetime.now().strftime("%d-%b-%Y"))
-
-    for row in range(6, ws.max_row + 1):
-        team_cell = ws[f"B{row}"]
-        team_name = str(team_cell.value).strip() if team_cell.value else ""
-        if team_name and team_name in team_tasks:
-            tasks_for_team = team_tasks[team_name]
-            print(f"[INFO] Summarizing team '{team_name}' with {len(tasks_for_team)} tasks.")
-            summary_text = summarize_team_tasks(tasks_for_team, max_points=5)
-            cell = ws[f"G{row}"]
-            cell.value = summary_text
-            cell.alignment = Alignment(wrap_text=True, horizontal="left", vertical="center")
-            lines = summary_text.count("\n") + 1
-            ws.row_dimensions[row].height = max(20, min(300, lines * 16))
-
-    wb.save(OUTPUT_FILE)
-    print(f"[INFO] Excel report generated: {OUTPUT_FILE}")
+def cell_text(cell, shared_strings):
+    if cell.get("t") == "s":
+        v = cell.find(f"{XLSX_NS}v")
+        return shared_strings[int(v.text)] if v is not None else ""
+    return "".join(cell.itertext())
+
+def add_summary_style(styles_xml, base_style_ids):
+    # Clone each summary-cell style with left/center wrapped alignment; returns the new
+    # styles.xml and a {old style id: new style id} map.
+    block = re.search(r"<cellXfs count=\"(\d+)\">(.*?)</cellXfs>", styles_xml, re.S)
+    xfs = re.findall(r"<xf\b[^>]*?(?:/>|>.*?</xf>)", block.group(2), re.S)
+    new_xfs, style_map = [], {}
+    for style_id in sorted(base_style_ids):
+        attrs = re.match(r"<xf\b([^>]*?)/?>", xfs[int(style_id)]).group(1)
+        attrs = re.sub(r'\s+applyAlignment="\d"', "", attrs)
+        new_xfs.append(
+            f'<xf{attrs} applyAlignment="1">'
+            '<alignment horizontal="left" vertical="center" wrapText="1"/></xf>'
+        )
+        style_map[style_id] = str(len(xfs) + len(new_xfs) - 1)
+    cell_xfs = f'<cellXfs count="{len(xfs) + len(new_xfs)}">{block.group(2)}{"".join(new_xfs)}</cellXfs>'
+    return styles_xml[:block.start()] + cell_xfs + styles_xml[block.end():], style_map
+
+@lru_cache(maxsize=1)
+def load_template():
+    # Read the template archive once; each run copies it verbatim and only patches
+    # the title placeholder, the summary column cells and their row heights.
+    with zipfile.ZipFile(TEMPLATE_FILE) as z:
+        members = {info.filename: z.read(info) for info in z.infolist()}
+
+    shared_strings = [
+        "".join(si.itertext())
+        for si in ET.fromstring(members[TEMPLATE_SHARED_STRINGS]).findall(f"{XLSX_NS}si")
+    ]
+    team_rows, summary_styles = {}, {}
+    for cell in ET.fromstring(members[TEMPLATE_SHEET]).iter(f"{XLSX_NS}c"):
+        col, row = re.match(r"([A-Z]+)(\d+)", cell.get("r")).groups()
+        row = int(row)
+        if row < TEMPLATE_FIRST_TEAM_ROW:
+            continue
+        if col == TEAM_COL:
+            team_name = cell_text(cell, shared_strings).strip()
+            if team_name:
+                team_rows[row] = team_name
+        elif col == SUMMARY_COL:
+            summary_styles[row] = cell.get("s", "0")
+
+    # Team rows without a G cell get one in the default style (0) when patched
+    summary_styles = {row: summary_styles.get(row, "0") for row in team_rows}
+    styles_xml, style_map = add_summary_style(
+        members[TEMPLATE_STYLES].decode("utf-8"), set(summary_styles.values())
+    )
+    members[TEMPLATE_STYLES] = styles_xml.encode("utf-8")
+    return {
+        "members": members,
+        "team_rows": team_rows,
+        "summary_styles": {row: style_map[s] for row, s in summary_styles.items()},
+    }
+
+def column_index(col):
+    idx = 0
+    for ch in col:
+        idx = idx * 26 + ord(ch) - ord("A") + 1
+    return idx
+
+def patch_sheet_xml(sheet_xml, summaries, summary_styles):
+    summary_col_idx = column_index(SUMMARY_COL)
+
+    def patch_row(match):
+        attrs, body = match.group(1), match.group(3) or ""
+        row = int(re.search(r'\br="(\d+)"', attrs).group(1))
+        if row not in summaries:
+            return match.group(0)
+        summary_text = summaries[row]
+        lines = summary_text.count("\n") + 1
+        height = max(20, min(300, lines * 16))
+        attrs = re.sub(r'\s+(?:ht|customHeight)="[^"]*"', "", attrs)
+        cell_ref = f"{SUMMARY_COL}{row}"
+        new_cell = (
+            f'<c r="{cell_ref}" s="{summary_styles[row]}" t="inlineStr">'
+            f'<is><t xml:space="preserve">{escape(_ILLEGAL_XML_CHARS.sub("", summary_text))}</t></is></c>'
+        )
+        cell_pattern = re.compile(rf'<c r="{cell_ref}"(?:[^>]*?/>|[^>]*>.*?</c>)', re.S)
+        if cell_pattern.search(body):
+            body = cell_pattern.sub(lambda _: new_cell, body, count=1)
+        else:
+            # Excel omits empty default-styled cells; insert one in column order
+            insert_at = len(body)
+            for cell in re.finditer(r'<c r="([A-Z]+)\d+"', body):
+                if column_index(cell.group(1)) > summary_col_idx:
+                    insert_at = cell.start()
+                    break
+            body = body[:insert_at] + new_cell + body[insert_at:]
+        return f'<row{attrs} ht="{height}" customHeight="1">{body}</row>'
+
+    # Self-closing <row .../> (empty rows with a custom height) must not swallow the next row
+    return re.sub(r"<row\b([^>]*?)(/>|>(.*?)</row>)", patch_row, sheet_xml, flags=re.S)
+
+def task_details(t):
+    if isinstance(t, dict):
+        return str(t.get("details") or "").strip()
+    if t is None or (isinstance(t, float) and pd.isna(t)):
+        return ""
+    return str(t).strip()
+
+def generate_excel_by_team(df):
+    team_tasks = {}
+    if not df.empty and "tasks" in df.columns:
+        tdf = df.reindex(columns=["team", "tasks"]).explode("tasks")
+        tdf["team"] = tdf["team"].fillna("").astype(str).str.strip()
+        tdf["details"] = tdf["tasks"].map(task_details)
+        team_tasks = tdf[tdf["details"] != ""].groupby("team", sort=False)["details"].apply(_normalize_tasks).to_dict()
+
+    template = load_template()
+    today_str = datetime.now().strftime("%d-%b-%Y")
+
+    # Pass 1: dispatch all team summaries concurrently (network-bound HF calls)
+    futures = {}
+    with ThreadPoolExecutor(max_workers=HF_MAX_WORKERS) as executor:
+        for team_name in template["team_rows"].values():
+            if team_name in team_tasks and team_name not in futures:
+                tasks_for_team = team_tasks[team_name]
+                LOG.info("Summarizing team '%s' with %s tasks.", team_name, len(tasks_for_team))
+                futures[team_name] = executor.submit(summarize_team_tasks, tasks_for_team, 5)
+
+    # Pass 2: copy the template archive, patching only the title and summary cells
+    summaries = {
+        row: futures[team_name].result()
+        for row, team_name in template["team_rows"].items()
+        if team_name in futures
+    }
+    with zipfile.ZipFile(OUTPUT_FILE, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, data in template["members"].items():
+            if name == TEMPLATE_SHARED_STRINGS:
+                data = data.replace(b"DD|MM|YYYY", today_str.encode("utf-8"))
+            elif name == TEMPLATE_SHEET:
+                data = patch_sheet_xml(data.decode("utf-8"), summaries, template["summary_styles"]).encode("utf-8")
+            z.writestr(name, data)
+
+    LOG.info("Excel report generated: %s", OUTPUT_FILE)
     return OUTPUT_FILE
 
-def generate_dept_team_summary(data):
-    summary = defaultdict(lambda: {"employees": set(), "reported": set()})
-    for record in data:
-        dept = record.get("department", "Unknown").strip()
-        team = record.get("team", "Unknown").strip()
-        emp = record.get("employee_name", "").strip()
-        if emp:
-            summary[(dept, team)]["employees"].add(emp)
-            if record.get("tasks") and len(record.get("tasks")) > 0:
-                summary[(dept, team)]["reported"].add(emp)
-    rows = ""
-    for (dept, team), info in sorted(summary.items()):
-        reported = len(info["reported"])
-        rows += f"""
-            <tr>
-                <td style="border:1px solid #ccc; padding:6px; text-align:center;">{dept}</td>
-                <td style="border:1px solid #ccc; padding:6px; text-align:center;">{team}</td>
-                <td style="border:1px solid #ccc; padding:6px; text-align:center;">{reported}</td>
-            </tr>
-        """
+def has_tasks(t):
+    # Same truthiness as record.get("tasks"); missing values become NaN in the DataFrame
+    if t is None or (isinstance(t, float) and pd.isna(t)):
+        return False
+    return bool(t)
+
+TD = '<td style="border:1px solid #ccc; padding:6px; text-align:center;">'
+
+def generate_dept_team_summary(df):
+    df = df.reindex(columns=["department", "team", "employee_name", "tasks"])
+    clean = pd.DataFrame({
+        "department": df["department"].fillna("Unknown").astype(str).str.strip(),
+        "team": df["team"].fillna("Unknown").astype(str).str.strip(),
+        "employee_name": df["employee_name"].fillna("").astype(str).str.strip(),
+        "has_tasks": df["tasks"].apply(has_tasks).astype(bool),
+    })
+    clean = clean[clean["employee_name"] != ""]
+    employees = clean.groupby(["department", "team"])["employee_name"].nunique()
+    reported = (
+        clean[clean["has_tasks"]]
+        .groupby(["department", "team"])["employee_name"].nunique()
+        .reindex(employees.index, fill_value=0)
+    )
+    parts = [
+        f"<tr>{TD}{dept}</td>{TD}{team}</td>{TD}{count}</td></tr>"
+        for (dept, team), count in reported.items()
+    ]
+    rows = "".join(parts)
     return f"""
     <table style="border-collapse:collapse; width:90%;">
       <thead>
@@ -216,8 +508,22 @@ def generate_dept_team_summary(data):
     </table>
     """
 
-def send_email(attachment, data):
-    html_table = generate_dept_team_summary(data)
+def open_smtp_connection():
+    s = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=60)
+    s.starttls()
+    s.login(SENDER_EMAIL, SENDER_PASSWORD)
+    return s
+
+def close_smtp_connection(s):
+    if s is None:
+        return
+    try:
+        s.quit()
+    except Exception:
+        s.close()
+
+def send_email(attachment, df, smtp_future=None):
+    html_table = generate_dept_team_summary(df)
     msg = EmailMessage()
     msg['Subject'] = f"📊 Daily Work Report Summary - {datetime.now().strftime('%d %B %Y')}"
     msg['From'] = SENDER_EMAIL
@@ -242,47 +548,139 @@ def send_email(attachment, data):
             subtype="vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             filename=os.path.basename(attachment)
         )
+    s = None
+    if smtp_future is not None:
+        try:
+            s = smtp_future.result()
+            # The pre-opened session may have idled out during summarization; noop() returns
+            # the server's reply (e.g. 451 timeout) rather than raising
+            code, reply = s.noop()
+            if code != 250:
+                raise smtplib.SMTPResponseException(code, reply)
+        except Exception as e:
+            LOG.warning("Pre-opened SMTP session unusable, reconnecting: %s", e)
+            close_smtp_connection(s)
+            s = None
+    reused = s is not None
     try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as s:
-            s.starttls()
-            s.login(SENDER_EMAIL, SENDER_PASSWORD)
-            s.send_message(msg)
-        print("[INFO] Email sent.")
+        if s is None:
+            s = open_smtp_connection()
+        try:
+            with s:
+                s.send_message(msg)
+        except smtplib.SMTPServerDisconnected as e:
+            if not reused:
+                raise
+            LOG.warning("Reused SMTP session dropped while sending, retrying on a new connection: %s", e)
+            with open_smtp_connection() as s:
+                s.send_message(msg)
+        LOG.info("Email sent.")
     except Exception as e:
-        print(f"[ERROR] Email send failed: {e}")
+        LOG.error("Email send failed: %s", e)
 
-def fetch_data():
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    coll = db[COLLECTION_NAME]
-    today = datetime.now().strftime("%Y-%m-%d")
-    data = list(coll.find({"date": today}))
-    client.close()
-    print(f"[INFO] Fetched {len(data)} records for {today}")
-    return data
+@lru_cache(maxsize=1)
+def get_collection():
+    # One pooled client per process instead of a fresh connection (and TLS handshake) per query
+    client = MongoClient(MONGO_URI, maxPoolSize=MONGO_POOL_SIZE)
+    return client[DB_NAME][COLLECTION_NAME]
 
-def export_to_csv(data):
-    if not data:
-        return None
-    df = pd.DataFrame(data)
-    if "_id" in df.columns:
-        df["_id"] = df["_id"].astype(str)
+def today_query():
+    return {"date": datetime.now().strftime("%Y-%m-%d")}
+
+def csv_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str, ensure_ascii=False)
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+def csv_fieldnames(coll, query):
+    # Distinct field names of today's documents, computed server-side (only keys cross the wire)
+    key_pipeline = [
+        {"$match": query},
+        {"$project": {"kv": {"$objectToArray": "$$ROOT"}}},
+        {"$unwind": "$kv"},
+        {"$group": {"_id": "$kv.k"}},
+    ]
+    return sorted(doc["_id"] for doc in coll.aggregate(key_pipeline))
+
+def fetch_data():
+    # Single pass over today's full documents: each one is streamed into the CSV export
+    # and only its report fields are kept in memory for the Excel/email summaries.
+    # A CSV failure is logged and never stops the report.
+    coll = get_collection()
+    query = today_query()
     path = f"mongo_export_{datetime.now().strftime('%Y%m%d')}.csv"
-    df.to_csv(path, index=False)
-    print(f"[INFO] Exported to {path}")
-    return path
+    f = writer = None
+    known, dropped = set(), set()
+    try:
+        fieldnames = csv_fieldnames(coll, query)
+        if fieldnames:
+            known = set(fieldnames)
+            f = open(path, "w", newline="", encoding="utf-8")
+            # Reports saved after the key scan may carry new fields; drop those rather than fail
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+            writer.writeheader()
+    except Exception as e:
+        LOG.error("CSV export failed: %s", e)
+        writer = None
 
-def daily_job():
-    print(f"[INFO] Starting daily job at {datetime.now()}")
-    data = fetch_data()
-    export_to_csv(data)
+    data = []
     try:
-        xfile = generate_excel_by_team(data)
+        for doc in coll.find(query, batch_size=MONGO_BATCH_SIZE):
+            data.append({k: doc[k] for k in REPORT_FIELDS if k in doc})
+            if writer is None:
+                continue
+            try:
+                dropped.update(doc.keys() - known)
+                writer.writerow({k: csv_value(v) for k, v in doc.items()})
+            except Exception as e:
+                LOG.error("CSV export failed: %s", e)
+                writer = None
+    finally:
+        if f is not None:
+            f.close()
+
+    LOG.info("Fetched %s records for %s", len(data), query["date"])
+    if dropped:
+        LOG.warning("CSV export skipped fields added after the key scan: %s", sorted(dropped))
+    if writer is not None:
+        LOG.info("Exported to %s", path)
+    return data
+
+def warm_up_hf_model():
+    # Trigger the HF cold start while MongoDB is being queried; the result is discarded.
+    # One attempt over the shared connection pool, outside _HF_SEMAPHORE so it never
+    # takes a slot from summarization.
+    payload = {"inputs": "warmup", "parameters": HF_PARAMETERS}
+    try:
+        body = orjson.dumps(payload) if orjson else json.dumps(payload).encode("utf-8")
+        resp = _WARMUP_SESSION.post(HF_API_URL, data=body, timeout=30)
+        LOG.info("HF warmup returned HTTP %s", resp.status_code)
     except Exception as e:
-        print(f"[ERROR] Excel generation failed: {e}")
-        return
-    send_email(xfile, data)
-    print("[DONE] Daily job completed successfully.")
+        LOG.warning("HF warmup failed: %s", e)
+
+def daily_job():
+    LOG.info("Starting daily job at %s", datetime.now())
+    threading.Thread(target=warm_up_hf_model, daemon=True).start()
+    prune_summary_cache()
+    with ThreadPoolExecutor(max_workers=1) as background:
+        # SMTP connect + STARTTLS + login overlap with the Mongo fetch and HF summarization
+        smtp_future = background.submit(open_smtp_connection)
+        try:
+            data = fetch_data()
+            df = pd.DataFrame(data)
+            try:
+                xfile = generate_excel_by_team(df)
+            except Exception as e:
+                LOG.error("Excel generation failed: %s", e)
+                return
+            send_email(xfile, df, smtp_future)
+        finally:
+            # QUIT whatever session is still open on every exit path (no-op once sent)
+            smtp_future.add_done_callback(lambda f: f.exception() or close_smtp_connection(f.result()))
+    LOG.info("Daily job completed successfully.")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
     daily_job()